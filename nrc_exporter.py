@@ -10,6 +10,9 @@
 import os
 from xml.etree import ElementTree
 import sys
+import asyncio
+import functools
+import threading
 import time
 import requests
 import argparse
@@ -20,10 +23,6 @@ import json
 from json.decoder import JSONDecodeError
 import datetime
 from colorama import Fore, Style
-from seleniumwire import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions
-from selenium.webdriver.common.by import By
 
 __version__ = "0.0.1"
 __author__ = "Yasoob Khalid"
@@ -46,6 +45,9 @@ ACTIVITY_LIST_PAGINATION = (
 ACTIVITY_DETAILS_URL = (
     "https://api.nike.com/sport/v3/me/activity/{activity_id}?metrics=ALL"
 )
+WATCH_INTERVAL = 300
+WATCH_SCAN_INTERVAL = 2
+WATCH_MIN_INTERVAL = 30
 
 LOGIN_BTN_CSS = (
     "button.join-log-in.text-color-grey.prl3-sm.pt2-sm.pb2-sm.fs12-sm.d-sm-b"
@@ -136,6 +138,36 @@ def warning(message):
     logger.warning(f_message(f"[-] ⚠️  {message}", level="error"))
 
 
+class NRCExporterError(Exception):
+    """
+    Base class for all the errors raised by nrc_exporter
+    """
+
+
+class AuthenticationError(NRCExporterError):
+    """
+    Raised when no valid access token could be obtained or Nike rejected it
+    """
+
+
+class LoginCancelled(AuthenticationError):
+    """
+    Raised when the user chooses not to continue with the manual login
+    """
+
+
+class APIError(NRCExporterError):
+    """
+    Raised when a request to the Nike API fails for a reason other than authentication
+    """
+
+
+class ConversionError(NRCExporterError):
+    """
+    Raised when an activity can not be converted to GPX
+    """
+
+
 def login(driver, email, password):
     """
     Open the login Page and sign in
@@ -148,6 +180,10 @@ def login(driver, email, password):
     Returns:
         Returns a boolean for whether the login was successful or not
     """
+    # selenium is only needed for logging in so it isn't imported by library users
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions
+    from selenium.webdriver.common.by import By
 
     info("Trying to log in")
     debug("Opening the login page")
@@ -228,11 +264,16 @@ def get_access_token(options):
 
     Returns:
         access_token: the bearer token that will be used to extract activities
+
+    Raises:
+        AuthenticationError: if the access token couldn't be obtained
     """
 
     login_success = False
 
     if options["gecko_path"] and not options["manual"]:
+        from seleniumwire import webdriver
+
         info(f"🚗 Starting gecko webdriver")
         driver = webdriver.Firefox(executable_path=options["gecko_path"])
         driver.scopes = [
@@ -255,18 +296,16 @@ def get_access_token(options):
         )
         accept = input()
         if not accept == "y":
-            info("You didn't want to continue. Exiting")
-            sys.exit(0)
+            raise LoginCancelled("You didn't want to continue. Exiting")
 
         webbrowser.open_new_tab(MOBILE_LOGIN_URL)
         info(f"Please paste access tokens here: \n")
         access_token = input()
         debug(f"Manually entered access token: {access_token}")
         if len(access_token) < 5:
-            error(
+            raise AuthenticationError(
                 f"You didn't paste access tokens. Please provide them using -t or --token argument"
             )
-            sys.exit(1)
 
     info(
         f"Closing the webdriver. From here on we will be using requests library instead"
@@ -275,49 +314,116 @@ def get_access_token(options):
     return access_token
 
 
-def get_activities_list(options):
+def get_api_json(url, options):
     """
-    Gets the list of activity IDs from Nike. For now it only saves the runs and not other activities
+    Requests a Nike API url and decodes the json response
 
     Args:
+        url: the API url
         options: the options dict which contains the access token
 
     Returns:
-        activity_ids: a list of running activity ids
+        data: the decoded json document
+
+    Raises:
+        AuthenticationError: if Nike didn't accept the access token
+        APIError: if the request failed or the response isn't usable
     """
 
-    info("🏃‍♀️  Getting activities list")
     headers = {
         "Authorization": f"Bearer {options['access_token']}",
     }
-    debug(f"headers: {headers}")
+    session = options.get("session", requests)
+    try:
+        response = session.get(url, headers=headers)
+    except requests.RequestException as e:
+        raise APIError(f"Request to {url} failed: {e}") from e
+
+    if response.status_code in (401, 403):
+        raise AuthenticationError("Are you sure you provided the correct access token?")
+    if not response.ok:
+        raise APIError(f"Nike returned HTTP {response.status_code} for {url}")
+    try:
+        data = response.json()
+    except ValueError as e:
+        raise APIError(
+            f"Nike returned a non-JSON response (HTTP {response.status_code}) for {url}"
+        ) from e
+    if not isinstance(data, dict):
+        raise APIError(f"Nike returned an unexpected response for {url}: {data}")
+    if "error_id" in data:
+        raise APIError(f"Nike returned an error (HTTP {response.status_code}) for {url}: {data}")
+    return data
+
+
+def get_activities_page(page_url, options):
+    """
+    Gets a single page of running activity IDs from Nike
+
+    Args:
+        page_url: the url of the activities page
+        options: the options dict which contains the access token
+
+    Returns:
+        activity_ids: a list of running activity ids on this page
+        next_page: the url of the next page or None if this was the last one
+
+    Raises:
+        AuthenticationError: if Nike didn't accept the access token
+        APIError: if the request failed or the response isn't usable
+    """
+
+    activity_list = get_api_json(page_url, options)
+    if "activities" not in activity_list or "paging" not in activity_list:
+        raise APIError(f"Nike returned an unexpected activities page for {page_url}")
+
+    activity_ids = []
+    for activity in activity_list["activities"]:
+        debug(f"Entry type: {activity.get('tags', {}).get('com.nike.running.runtype', 'unknow type')}")
+        if (
+            activity["type"] == "run"
+            and activity.get("tags", {}).get("com.nike.running.runtype", "") != "manual"
+        ):
+            # activity["tags"]["location"].lower() == "outdoors":
+            activity_ids.append(activity.get("id"))
+
+    next_page = None
+    if activity_list["paging"].get("before_id"):
+        next_page = ACTIVITY_LIST_PAGINATION.format(
+            before_id=activity_list["paging"]["before_id"]
+        )
+    return activity_ids, next_page
+
+
+def get_activities_list(options, max_pages=None):
+    """
+    Gets the list of activity IDs from Nike. For now it only saves the runs and not other activities
+
+    Args:
+        options: the options dict which contains the access token
+        max_pages: stop after this many pages. All pages are fetched if None
+
+    Returns:
+        activity_ids: a list of running activity ids
+
+    Raises:
+        AuthenticationError: if Nike didn't accept the access token
+        APIError: if the request failed or the response isn't usable
+    """
+
+    info("🏃‍♀️  Getting activities list")
     activity_ids = []
     page_num = 1
     next_page = ACTIVITY_LIST_URL
-    more = True
-    while more:
+    while True:
         info(f"📃  opening page {page_num} of activities")
         debug(f"\tActivities page url: {next_page}")
-        activity_list = requests.get(next_page, headers=headers)
-        if "error_id" in activity_list.json().keys():
-            error("Are you sure you provided the correct access token?")
-            sys.exit()
-        for activity in activity_list.json()["activities"]:
-            debug(f"Entry type: {activity.get('tags', {}).get('com.nike.running.runtype', 'unknow type')}")
-            if (
-                activity["type"] == "run"
-                and activity.get("tags", {}).get("com.nike.running.runtype", "") != "manual"
-            ):
-                # activity["tags"]["location"].lower() == "outdoors":
-                activity_ids.append(activity.get("id"))
-
-        if activity_list.json()["paging"].get("before_id"):
-            page_num += 1
-            next_page = ACTIVITY_LIST_PAGINATION.format(
-                before_id=activity_list.json()["paging"]["before_id"]
-            )
-            continue
-        break
+        page_ids, next_page = get_activities_page(next_page, options)
+        activity_ids.extend(page_ids)
+
+        if not next_page or (max_pages and page_num >= max_pages):
+            break
+        page_num += 1
 
     info(
         f"🏃‍♀️  Successfully extracted {len(activity_ids)} running activities from {page_num} pages"
@@ -329,16 +435,118 @@ def get_activities_list(options):
 def get_activity_details(activity_id, options):
     """
     Extracts details for a specific activity
+
+    Args:
+        activity_id: the id of the activity
+        options: the options dict which contains the access token
+
+    Returns:
+        activity: the json document for the activity
+
+    Raises:
+        AuthenticationError: if Nike didn't accept the access token
+        APIError: if the request failed or the response isn't usable
     """
 
     info(f"Getting activity details for {activity_id}")
-    headers = {
-        "Authorization": f"Bearer {options['access_token']}",
-    }
-    html = requests.get(
-        ACTIVITY_DETAILS_URL.format(activity_id=activity_id), headers=headers
-    )
-    return html.json()
+    return get_api_json(ACTIVITY_DETAILS_URL.format(activity_id=activity_id), options)
+
+
+class NRCClient:
+    """
+    An asyncio friendly client for the NRC API. The blocking HTTP requests
+    run in an executor so many clients can share one event loop, and
+    concurrent calls on the same client are fine too. Every executor thread
+    gets its own requests.Session so the size of the executor limits how
+    many requests are in flight at once.
+
+    A session passed in by the caller is used from all the executor threads
+    and is never closed by the client. Pass a single worker executor with it
+    if it isn't safe to share between threads.
+
+    Args:
+        access_token: the bearer token used to extract activities
+        session: an optional requests.Session to reuse connections
+        executor: an optional concurrent.futures executor for the requests
+    """
+
+    def __init__(self, access_token, session=None, executor=None):
+        self.access_token = access_token
+        self.session = session
+        self.executor = executor
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _options(self):
+        """
+        Returns the options dict for the current executor thread
+        """
+        session = self.session or getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return {"access_token": self.access_token, "session": session}
+
+    def _call(self, func, *args):
+        return func(*args, self._options())
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(self._call, func, *args)
+        )
+
+    async def list_activities(self, max_pages=None):
+        """
+        Yields the running activity IDs, newest first
+
+        Args:
+            max_pages: stop after this many pages. All pages are fetched if None
+        """
+        page_num = 1
+        next_page = ACTIVITY_LIST_URL
+        while next_page:
+            activity_ids, next_page = await self._run(get_activities_page, next_page)
+            for activity_id in activity_ids:
+                yield activity_id
+            if max_pages and page_num >= max_pages:
+                break
+            page_num += 1
+
+    async def fetch_activity(self, activity_id):
+        """
+        Returns the json document for a specific activity
+        """
+        return await self._run(get_activity_details, activity_id)
+
+    async def fetch_activities(self, max_pages=None):
+        """
+        Yields the json documents for the running activities, newest first
+
+        Args:
+            max_pages: stop after this many pages. All pages are fetched if None
+        """
+        async for activity_id in self.list_activities(max_pages=max_pages):
+            yield await self.fetch_activity(activity_id)
+
+    def close(self):
+        """
+        Closes the HTTP sessions created by the client
+        """
+        with self._sessions_lock:
+            sessions, self._sessions = self._sessions, []
+            self._local = threading.local()
+        for session in sessions:
+            session.close()
 
 
 def save_activity(activity_json, activity_id):
@@ -464,7 +672,7 @@ def parse_activity_data(activity):
     debug(
         f"\tActivity {activity['id']} contains the following metrics: {activity['metric_types']}"
     )
-    if not any([lat_index, lon_index]):
+    if lat_index is None or lon_index is None:
         warning(
             f"\tThe activity {activity['id']} doesn't contain latitude/longitude information"
         )
@@ -472,11 +680,16 @@ def parse_activity_data(activity):
 
     latitude_data = activity["metrics"][lat_index]["values"]
     longitude_data = activity["metrics"][lon_index]["values"]
+    if not latitude_data or not longitude_data:
+        warning(
+            f"\tThe activity {activity['id']} doesn't contain any latitude/longitude values"
+        )
+        return None
     elevation_data = None
     heart_rate_data = None
-    if ascent_index:
+    if ascent_index is not None:
         elevation_data = activity["metrics"][ascent_index]["values"]
-    if heart_rate_index:
+    if heart_rate_index is not None:
         heart_rate_data = activity["metrics"][heart_rate_index]["values"]
 
     title = activity.get("tags", {}).get("com.nike.name", "")
@@ -486,6 +699,38 @@ def parse_activity_data(activity):
     return gpx_doc
 
 
+def convert(activity):
+    """
+    Converts a NRC activity to GPX without touching the disk
+
+    Args:
+        activity: a json document for a NRC activity
+
+    Returns:
+        gpx: the GPX XML doc for the input activity encoded as UTF-8
+
+    Raises:
+        ConversionError: if the activity is malformed or doesn't contain GPS data
+    """
+
+    if not isinstance(activity, dict):
+        raise ConversionError(
+            f"Expected the activity to be a dict, got {type(activity).__name__}"
+        )
+    activity_id = activity.get("id")
+    try:
+        gpx_doc = parse_activity_data(activity)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ConversionError(
+            f"The activity {activity_id} is malformed: {e!r}"
+        ) from e
+    if gpx_doc is None:
+        raise ConversionError(
+            f"The activity {activity_id} doesn't contain GPS data"
+        )
+    return gpx_doc.encode("utf-8")
+
+
 def save_gpx(gpx_data, activity_id):
     """
     Saves the GPX data to a file on disk
@@ -500,6 +745,34 @@ def save_gpx(gpx_data, activity_id):
         f.write(gpx_data)
 
 
+def convert_activity_file(file_path):
+    """
+    Reads a NRC activity JSON file and saves it as GPX
+
+    Args:
+        file_path: the path to the activity JSON file
+
+    Returns:
+        Returns a boolean for whether a GPX file was written or not
+    """
+
+    with open(file_path, "r") as f:
+        try:
+            json_data = json.loads(f.read())
+        except JSONDecodeError:
+            error(f"Error occured while parsing file {file_path}")
+            return False
+    if not isinstance(json_data, dict):
+        error(f"The file {file_path} doesn't contain a NRC activity")
+        return False
+    debug(f"Parsing file: {file_path}")
+    parsed_data = parse_activity_data(json_data)
+    if not parsed_data:
+        return False
+    save_gpx(parsed_data, json_data["id"])
+    return True
+
+
 def get_gecko_path():
     """
     Check if geckodriver exists in the code directory. If it does, return
@@ -518,6 +791,115 @@ def get_gecko_path():
         return None
 
 
+def list_activity_files(paths):
+    """
+    Collects the activity JSON files from a list of directories and files
+
+    Args:
+        paths: a list of directories and/or JSON file paths
+
+    Returns:
+        mtimes: a dict mapping every JSON file path to its modification time
+    """
+
+    mtimes = {}
+    for path in paths:
+        try:
+            files = [os.path.join(path, f) for f in os.listdir(path)]
+        except NotADirectoryError:
+            files = [path]
+        except FileNotFoundError:
+            warning(f"{path} doesn't exist anymore")
+            continue
+        for file_path in files:
+            if not file_path.endswith(".json"):
+                continue
+            try:
+                mtimes[file_path] = os.stat(file_path).st_mtime
+            except FileNotFoundError:
+                # The file was removed between listing and stat
+                continue
+    return mtimes
+
+
+def sync_new_activities(options, known_ids):
+    """
+    Downloads the activities from the first page which haven't been saved yet.
+    Failed downloads are logged and retried on the next call
+
+    Args:
+        options: the options dict which contains the access token
+        known_ids: a set of the activity ids which are already saved. It is
+            updated with the newly saved ids
+
+    Raises:
+        AuthenticationError: if Nike didn't accept the access token
+    """
+
+    try:
+        activity_ids = get_activities_list(options, max_pages=1)
+    except AuthenticationError:
+        raise
+    except NRCExporterError as e:
+        error(f"Unable to get the activities list, will retry later: {e}")
+        return
+
+    for activity in activity_ids:
+        if activity in known_ids:
+            continue
+        try:
+            activity_details = get_activity_details(activity, options)
+        except AuthenticationError:
+            raise
+        except NRCExporterError as e:
+            error(f"Unable to get activity {activity}, will retry later: {e}")
+            continue
+        save_activity(activity_details, activity)
+        known_ids.add(activity)
+
+
+def watch(options):
+    """
+    Keeps running and converts new activities as they show up. The first
+    page of activities is polled every `interval` seconds using the same
+    HTTP session and access token, and the input folders are rescanned
+    every few seconds so that new or modified JSON files get converted
+
+    Args:
+        options: the options dict which contains the access token and the folders to watch
+    """
+
+    interval = options.get("interval", WATCH_INTERVAL)
+    watch_paths = options.get("activities_dirs", [ACTIVITY_FOLDER])
+    known_files = list_activity_files(watch_paths)
+    known_ids = set(
+        os.path.splitext(f)[0] for f in os.listdir(ACTIVITY_FOLDER) if f.endswith(".json")
+    )
+    next_poll = time.time() + interval
+
+    info(f"👀 Watching {','.join(watch_paths)} for new activities. Press Ctrl+C to stop")
+    try:
+        while True:
+            if options.get("access_token") and time.time() >= next_poll:
+                next_poll = time.time() + interval
+                sync_new_activities(options, known_ids)
+
+            current_files = list_activity_files(watch_paths)
+            for file_path, mtime in current_files.items():
+                if known_files.get(file_path) == mtime:
+                    continue
+                info(f"Found new activity file {file_path}")
+                try:
+                    convert_activity_file(file_path)
+                except (KeyError, TypeError, ValueError, OSError) as e:
+                    error(f"Unable to convert {file_path}: {e!r}")
+            known_files = current_files
+
+            time.sleep(WATCH_SCAN_INTERVAL)
+    except KeyboardInterrupt:
+        info("Stopped watching for new activities")
+
+
 def arg_parser():
     """
     Parses the input arguments
@@ -537,7 +919,17 @@ def arg_parser():
         "-i", "--input", nargs='+', help="A directory or directories containing NRC activities in JSON format."
         "You can also provide individual NRC JSON files"
     )
+    ap.add_argument(
+        "-w", "--watch", action="store_true",
+        help="keep running and convert new activities as they show up",
+    )
+    ap.add_argument(
+        "--interval", type=int, default=WATCH_INTERVAL,
+        help=f"seconds between checks for new activities in watch mode (default: {WATCH_INTERVAL})",
+    )
     args = ap.parse_args()
+    if args.interval < WATCH_MIN_INTERVAL:
+        ap.error(f"--interval must be at least {WATCH_MIN_INTERVAL} seconds")
 
     if args.verbose:
         logger = logging.getLogger(__name__)
@@ -551,6 +943,8 @@ def arg_parser():
     options = {}
     options["debug"] = args.verbose
     options["manual"] = False
+    options["watch"] = args.watch
+    options["interval"] = args.interval
     if args.input:
         if all([os.path.exists(i) for i in args.input]):
             options["activities_dirs"] = args.input
@@ -600,12 +994,28 @@ def main():
     Main will be called if the script is run directly
     """
 
+    try:
+        run()
+    except LoginCancelled as e:
+        info(str(e))
+        sys.exit(0)
+    except NRCExporterError as e:
+        error(str(e))
+        sys.exit(1)
+
+
+def run():
+    """
+    Runs the exporter using the command line arguments
+    """
+
     init_logger()
     options = arg_parser()
 
     info("Starting NRC Exporter")
 
     start_time = time.time()
+    options["session"] = requests.Session()
 
     if options.get("email") or options.get("manual"):
         info("💉  Email and password provided so will try to extract access tokens")
@@ -628,16 +1038,8 @@ def main():
 
     total_parsed_count = 0
     for file_path in activity_files:
-        with open(file_path, "r") as f:
-            try:
-                json_data = json.loads(f.read())
-            except JSONDecodeError:
-                error(f"Error occured while parsing file {file_path}")
-        debug(f"Parsing file: {file_path}")
-        parsed_data = parse_activity_data(json_data)
-        if parsed_data:
+        if convert_activity_file(file_path):
             total_parsed_count += 1
-            save_gpx(parsed_data, json_data["id"])
 
     info(
         f"Parsed {total_parsed_count} activities successfully out of {len(activity_files)} total run activities"
@@ -646,6 +1048,9 @@ def main():
         f"Total time taken: {time.strftime('%H:%M:%S', time.gmtime(time.time() - start_time))}"
     )
 
+    if options["watch"]:
+        watch(options)
+
 
 if __name__ == "__main__":
     main()
@@ -18,14 +18,13 @@ setuptools.setup(
     install_requires=REQUIRES,
     classifiers=[
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: Implementation :: CPython",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.4",
+    python_requires=">=3.7",
     py_modules=["nrc_exporter"],
     entry_points={"console_scripts": ["nrc-exporter = nrc_exporter:main"]},
 )
@@ -0,0 +1,270 @@
+import asyncio
+import json
+
+import pytest
+import requests
+
+import nrc_exporter
+
+
+def make_response(status_code=200, body=None, text=None):
+    response = requests.Response()
+    response.status_code = status_code
+    if text is None:
+        text = json.dumps(body)
+    response._content = text.encode("utf-8")
+    return response
+
+
+class FakeSession:
+    """
+    A stand-in for requests.Session which returns canned responses by url.
+    A list of responses is returned one per request
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.urls = []
+
+    def get(self, url, headers):
+        self.urls.append(url)
+        response = self.responses[url]
+        if isinstance(response, list):
+            response = response.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def make_options(responses):
+    return {"access_token": "token", "session": FakeSession(responses)}
+
+
+def make_activity(activity_id="abc", metrics=None):
+    if metrics is None:
+        metrics = [
+            {"type": "latitude", "values": [{"start_epoch_ms": 1000, "end_epoch_ms": 2000, "value": 1.0}]},
+            {"type": "longitude", "values": [{"start_epoch_ms": 1000, "end_epoch_ms": 2000, "value": 2.0}]},
+        ]
+    return {
+        "id": activity_id,
+        "metric_types": [metric["type"] for metric in metrics],
+        "metrics": metrics,
+    }
+
+
+def details_url(activity_id):
+    return nrc_exporter.ACTIVITY_DETAILS_URL.format(activity_id=activity_id)
+
+
+def page(activity_ids, before_id=None):
+    return make_response(body={
+        "activities": [{"type": "run", "id": activity_id} for activity_id in activity_ids],
+        "paging": {"before_id": before_id} if before_id else {},
+    })
+
+
+@pytest.mark.parametrize("response, exception", [
+    (make_response(401, {"error_id": "x"}), nrc_exporter.AuthenticationError),
+    (make_response(403, {"error_id": "x"}), nrc_exporter.AuthenticationError),
+    (make_response(404, {"error_id": "x"}), nrc_exporter.APIError),
+    (make_response(500, {"message": "internal"}), nrc_exporter.APIError),
+    (make_response(502, text="<html>Bad Gateway</html>"), nrc_exporter.APIError),
+    (make_response(200, {"error_id": "x"}), nrc_exporter.APIError),
+    (make_response(200, [1, 2]), nrc_exporter.APIError),
+    (requests.ConnectionError("blip"), nrc_exporter.APIError),
+])
+def test_get_activity_details_errors(response, exception):
+    options = make_options({details_url("abc"): response})
+    with pytest.raises(exception):
+        nrc_exporter.get_activity_details("abc", options)
+
+
+def test_get_activities_page_missing_keys():
+    options = make_options({nrc_exporter.ACTIVITY_LIST_URL: make_response(body={"message": "?"})})
+    with pytest.raises(nrc_exporter.APIError):
+        nrc_exporter.get_activities_page(nrc_exporter.ACTIVITY_LIST_URL, options)
+
+
+def test_get_activities_page_skips_manual_runs():
+    body = {
+        "activities": [
+            {"type": "run", "id": "a1"},
+            {"type": "run", "id": "a2", "tags": {"com.nike.running.runtype": "manual"}},
+        ],
+        "paging": {"before_id": "a1"},
+    }
+    options = make_options({nrc_exporter.ACTIVITY_LIST_URL: make_response(body=body)})
+    activity_ids, next_page = nrc_exporter.get_activities_page(nrc_exporter.ACTIVITY_LIST_URL, options)
+    assert activity_ids == ["a1"]
+    assert next_page == nrc_exporter.ACTIVITY_LIST_PAGINATION.format(before_id="a1")
+
+
+def test_convert():
+    gpx = nrc_exporter.convert(make_activity())
+    assert isinstance(gpx, bytes)
+    assert b"<trkpt" in gpx
+
+
+def test_convert_keeps_elevation_in_first_metric():
+    metrics = [
+        {"type": "ascent", "values": [
+            {"start_epoch_ms": 0, "end_epoch_ms": 1000, "value": 5.0},
+            {"start_epoch_ms": 1000, "end_epoch_ms": 2000, "value": 6.0},
+        ]},
+    ] + make_activity()["metrics"]
+    assert b"<ele>5.0</ele>" in nrc_exporter.convert(make_activity(metrics=metrics))
+
+
+@pytest.mark.parametrize("activity", [
+    [],
+    None,
+    "x",
+    {"id": "x"},
+    {"id": "x", "metrics": make_activity()["metrics"]},
+    make_activity(metrics=[{"type": "latitude", "values": []}]),
+    make_activity(metrics=[{"type": "foo", "values": []}, {"type": "latitude", "values": []}]),
+    make_activity(metrics=[{"type": "latitude", "values": []}, {"type": "longitude", "values": []}]),
+])
+def test_convert_errors(activity):
+    with pytest.raises(nrc_exporter.ConversionError):
+        nrc_exporter.convert(activity)
+
+
+def collect(async_iterator):
+    async def run():
+        return [item async for item in async_iterator]
+    return asyncio.run(run())
+
+
+def test_client_list_activities_pagination():
+    second_page = nrc_exporter.ACTIVITY_LIST_PAGINATION.format(before_id="a1")
+    session = FakeSession({
+        nrc_exporter.ACTIVITY_LIST_URL: page(["a1"], before_id="a1"),
+        second_page: page(["a2"]),
+    })
+    client = nrc_exporter.NRCClient("token", session=session)
+    assert collect(client.list_activities()) == ["a1", "a2"]
+    assert collect(client.list_activities(max_pages=1)) == ["a1"]
+
+
+def test_client_fetch_activities():
+    session = FakeSession({
+        nrc_exporter.ACTIVITY_LIST_URL: page(["a1", "a2"]),
+        details_url("a1"): make_response(body=make_activity("a1")),
+        details_url("a2"): make_response(body=make_activity("a2")),
+    })
+    client = nrc_exporter.NRCClient("token", session=session)
+    assert [activity["id"] for activity in collect(client.fetch_activities())] == ["a1", "a2"]
+
+
+def test_client_close_only_closes_own_sessions(monkeypatch):
+    created = []
+
+    class TrackingSession(FakeSession):
+        def __init__(self):
+            super().__init__({details_url("a1"): make_response(body=make_activity("a1"))})
+            self.closed = False
+            created.append(self)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(nrc_exporter.requests, "Session", TrackingSession)
+
+    async def run(client):
+        async with client:
+            await client.fetch_activity("a1")
+        await client.fetch_activity("a1")
+        client.close()
+
+    asyncio.run(run(nrc_exporter.NRCClient("token")))
+    # a fresh session is created after close instead of reusing the closed one
+    assert len(created) == 2
+    assert all(session.closed for session in created)
+
+    shared = TrackingSession()
+    asyncio.run(run(nrc_exporter.NRCClient("token", session=shared)))
+    assert not shared.closed
+
+
+@pytest.fixture
+def folders(tmp_path, monkeypatch):
+    activity_folder = tmp_path / "activities"
+    gpx_folder = tmp_path / "gpx_output"
+    activity_folder.mkdir()
+    gpx_folder.mkdir()
+    monkeypatch.setattr(nrc_exporter, "ACTIVITY_FOLDER", str(activity_folder))
+    monkeypatch.setattr(nrc_exporter, "GPX_FOLDER", str(gpx_folder))
+    return activity_folder, gpx_folder
+
+
+def run_watch(monkeypatch, options, ticks):
+    """
+    Runs watch() calling every function in ticks in place of the sleep
+    between two iterations, then stops it like Ctrl+C would
+    """
+    ticks = list(ticks)
+
+    def sleep(seconds):
+        if not ticks:
+            raise KeyboardInterrupt
+        ticks.pop(0)()
+
+    monkeypatch.setattr(nrc_exporter.time, "sleep", sleep)
+    nrc_exporter.watch(options)
+
+
+def test_watch_skips_bad_files(folders, monkeypatch):
+    activity_folder, gpx_folder = folders
+
+    def drop_files():
+        (activity_folder / "list.json").write_text("[1, 2]")
+        (activity_folder / "junk.json").write_text("{not json")
+        (activity_folder / "no_metric_types.json").write_text(
+            json.dumps({"id": "x", "metrics": make_activity()["metrics"]})
+        )
+        (activity_folder / "good.json").write_text(json.dumps(make_activity("good")))
+
+    def remove_folder():
+        for path in activity_folder.iterdir():
+            path.unlink()
+        activity_folder.rmdir()
+
+    run_watch(monkeypatch, {}, [drop_files, remove_folder, lambda: None])
+    assert [path.name for path in gpx_folder.iterdir()] == ["good.gpx"]
+
+
+def test_watch_survives_failed_polls(folders, monkeypatch):
+    activity_folder, gpx_folder = folders
+    options = make_options({
+        nrc_exporter.ACTIVITY_LIST_URL: [
+            make_response(500, {"message": "internal"}),
+            requests.ConnectionError("blip"),
+            make_response(502, text="<html>Bad Gateway</html>"),
+            page(["a1"]),
+            page(["a1"]),
+        ],
+        details_url("a1"): [
+            make_response(404, {"error_id": "x"}),
+            make_response(body=make_activity("a1")),
+        ],
+    })
+    options["interval"] = 0
+
+    run_watch(monkeypatch, options, [lambda: None] * 4)
+    assert (activity_folder / "a1.json").exists()
+    assert (gpx_folder / "a1.gpx").exists()
+
+
+def test_watch_stops_on_authentication_error(folders, monkeypatch):
+    options = make_options({
+        nrc_exporter.ACTIVITY_LIST_URL: make_response(401, {"error_id": "x"}),
+    })
+    options["interval"] = 0
+
+    with pytest.raises(nrc_exporter.AuthenticationError):
+        run_watch(monkeypatch, options, [])